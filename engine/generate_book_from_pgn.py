@@ -5,17 +5,20 @@ Generador de Opening Book desde archivos PGN.
 Analiza partidas de bases de datos PGN y genera un opening_book.cpp
 basado en estadísticas reales de jugadores fuertes.
 
-Requiere: pip install python-chess
+Requiere: pip install python-chess numpy
 
 Uso:
   python generate_book_from_pgn.py --input masters.pgn --output opening_book_generated.cpp
   python generate_book_from_pgn.py --input masters.pgn --min-elo 2500 --min-games 10
 """
 
+import io
+import mmap
+import multiprocessing
 import re
 import sys
 import argparse
-from collections import defaultdict, Counter
+from collections import defaultdict
 from typing import Dict, List, Tuple
 from dataclasses import dataclass
 
@@ -27,31 +30,261 @@ except ImportError:
     print("Instala con: pip install python-chess")
     sys.exit(1)
 
+try:
+    import numpy as np
+except ImportError:
+    print("ERROR: Se requiere numpy")
+    print("Instala con: pip install numpy")
+    sys.exit(1)
+
+# Numba es opcional: si está instalado, el bucle de agregación W/D/L
+# se compila a código nativo; si no, corre la versión Python pura.
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+
+        def wrap(func):
+            return func
+        return wrap
+
+# Columnas de los arrays de contadores por posición
+_W, _D, _L, _N = 0, 1, 2, 3
+
+# Columna W/D/L a incrementar según (quien mueve, código de resultado):
+# _WDL_COL[0 si mueven blancas, 1 si negras][rc] con rc 0="1-0",
+# 1="0-1", 2=tablas. Evita comparar strings de resultado por ply.
+_WDL_COL = ((_W, _L, _D), (_L, _W, _D))
+
+# Tabla Zobrist para claves de prefijo incrementales: una entrada por
+# (casilla origen, casilla destino, pieza de promoción 0-6). Semilla fija
+# para que las claves sean reproducibles entre workers de multiprocessing.
+_zob_rng = np.random.default_rng(0xC0FFEE)
+_ZOBRIST = _zob_rng.integers(1, 2**63, size=(64, 64, 7), dtype=np.uint64).tolist()
+del _zob_rng
+
+# La clave se actualiza como hash rodante: key = (key * MULT) ^ zobrist,
+# con MULT impar (biyectivo mod 2^64). A diferencia del XOR puro, es
+# sensible al orden de los movimientos, así que órdenes transpuestos
+# (1.d4 Nf6 2.c4 vs 1.c4 Nf6 2.d4) conservan entradas separadas en el
+# libro, igual que con los prefijos-string del formato original.
+_HASH_MULT = 0x9E3779B97F4A7C15
+_HASH_MASK = 0xFFFFFFFFFFFFFFFF
+
+
+@njit(cache=True, boundscheck=False)
+def _update_stats(rows, cols, n, counts):
+    """Aplica los incrementos W/D/L bufereados de una partida completa.
+
+    Solo aritmética entera sobre arrays para que Numba pueda compilarlo;
+    las resoluciones de diccionario ocurren antes, en el bucle Python.
+    """
+    for i in range(n):
+        row = rows[i]
+        counts[row, 3] += 1          # _N
+        counts[row, cols[i]] += 1    # _W/_D/_L según _WDL_COL
+
+
+def precompile_kernels():
+    """Compila los kernels Numba llamándolos con entradas mínimas.
+
+    Con @njit(cache=True) el resultado queda cacheado en disco, así la
+    primera corrida real no paga el costo de compilación JIT.
+    """
+    if not HAVE_NUMBA:
+        print("numba no está instalado; no hay kernels que precompilar")
+        return
+
+    _update_stats(np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.int64),
+                  1, np.zeros((1, 4), dtype=np.uint32))
+    print("✓ Kernels Numba compilados y cacheados")
+
+
+def _zobrist_of_prefix(prefix: str) -> int:
+    """Clave rodante de una secuencia de movimientos UCI separada por espacios."""
+    key = 0
+    for uci in prefix.split():
+        move = chess.Move.from_uci(uci)
+        key = ((key * _HASH_MULT) & _HASH_MASK) \
+            ^ _ZOBRIST[move.from_square][move.to_square][move.promotion or 0]
+    return key
+
 
 @dataclass
-class MoveStats:
-    """Estadísticas de un movimiento en una posición."""
+class BookMove:
+    """Movimiento candidato ya filtrado, listo para emitir al libro."""
     uci: str
-    wins: int = 0
-    draws: int = 0
-    losses: int = 0
-    count: int = 0
-    
-    @property
-    def score(self) -> float:
-        """Score ponderado: wins=1, draws=0.5, losses=0"""
-        if self.count == 0:
-            return 0.5
-        return (self.wins + 0.5 * self.draws) / self.count
-    
-    @property
-    def weight(self) -> int:
-        """Peso para el libro basado en popularidad y rendimiento."""
-        # Fórmula: popularidad (log scale) * rendimiento
-        import math
-        popularity = min(100, int(20 * math.log(self.count + 1)))
-        performance = int(self.score * 100)
-        return min(100, (popularity + performance) // 2)
+    count: int
+    score: float
+    weight: int
+
+
+_RESULT_TOKENS = frozenset(('1-0', '0-1', '1/2-1/2', '*'))
+
+
+def _fast_pgn_iter(pgn_file):
+    """Itera partidas de un PGN sin construir el árbol Game de python-chess.
+
+    Pequeña máquina de estados sobre las líneas del archivo: reconoce pares
+    de tags `[Clave "Valor"]`, comentarios `{...}` y `;`, variantes `(...)`
+    y NAGs `$n`, y descarta todo salvo los tokens SAN de la línea principal.
+
+    Yields:
+        (headers, san_tokens): dict de headers y lista de tokens SAN.
+    """
+    headers = {}
+    san_tokens = []
+    in_movetext = False
+    in_comment = False   # dentro de {...}
+    var_depth = 0        # profundidad de variantes (...)
+
+    for line in pgn_file:
+        if not in_comment and var_depth == 0 and line.startswith('['):
+            if in_movetext:
+                # Tag de la siguiente partida: emitir la anterior
+                yield headers, san_tokens
+                headers = {}
+                san_tokens = []
+                in_movetext = False
+
+            # Parsear `[Clave "Valor"]` con find (bucle a nivel C)
+            quote = line.find('"')
+            if quote > 0:
+                end_quote = line.rfind('"')
+                key = line[1:quote].strip()
+                if key:
+                    headers[key] = line[quote + 1:end_quote]
+            continue
+
+        stripped = line.strip()
+        if not stripped:
+            continue
+
+        in_movetext = True
+        i = 0
+        n = len(line)
+        while i < n:
+            if in_comment:
+                close = line.find('}', i)
+                if close == -1:
+                    i = n
+                else:
+                    in_comment = False
+                    i = close + 1
+                continue
+
+            # Próximo carácter especial; entre medio hay tokens "limpios"
+            j = i
+            while j < n and line[j] not in '{};()':
+                j += 1
+
+            if var_depth == 0 and j > i:
+                for tok in line[i:j].split():
+                    if tok in _RESULT_TOKENS:
+                        continue
+                    if tok.startswith('$'):
+                        continue
+                    # Quitar sufijos de anotación ("e4!?", "Ng5?!") y
+                    # números de jugada pegados ("1.e4", "3...c5"),
+                    # preservando enroques con cero ("0-0", "12.0-0-0")
+                    tok = tok.rstrip('!?')
+                    zero = tok.find('0-0')
+                    if zero != -1:
+                        tok = tok[zero:]
+                    else:
+                        tok = tok.lstrip('.0123456789')
+                    if tok:
+                        san_tokens.append(tok)
+
+            if j >= n:
+                break
+            ch = line[j]
+            if ch == '{':
+                in_comment = True
+            elif ch == '(':
+                var_depth += 1
+            elif ch == ')':
+                if var_depth > 0:
+                    var_depth -= 1
+            elif ch == ';':
+                break  # comentario hasta fin de línea
+            i = j + 1
+
+    if in_movetext or headers:
+        yield headers, san_tokens
+
+
+def _scan_game_offsets(filepath: str) -> List[Tuple[int, int]]:
+    """Encuentra los límites de byte de cada partida del archivo PGN.
+
+    Escanea el archivo con mmap buscando tags `[Event "..."]` al inicio
+    de línea y precedidos de línea en blanco (o inicio de archivo), que
+    en PGN estándar siempre abren una partida nueva. El ancla incluye
+    el espacio y la comilla para no confundir tags suplementarios como
+    [EventDate] o [EventType] con límites de partida.
+
+    Returns:
+        Lista de tuplas (inicio, fin) alineadas a partidas.
+    """
+    starts = []
+    with open(filepath, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            size = len(mm)
+            pos = mm.find(b'[Event "')
+            while pos != -1:
+                if pos == 0:
+                    starts.append(pos)
+                elif mm[pos - 1:pos] == b'\n':
+                    # Debe haber una línea en blanco antes (tolerando \r\n)
+                    j = pos - 2
+                    if mm[j:j + 1] == b'\r':
+                        j -= 1
+                    if j < 0 or mm[j:j + 1] == b'\n':
+                        starts.append(pos)
+                pos = mm.find(b'[Event "', pos + 1)
+        finally:
+            mm.close()
+
+    if not starts:
+        return []
+    return [(start, end) for start, end in
+            zip(starts, starts[1:] + [size])]
+
+
+def _ingest_range(task) -> Tuple[int, int, Dict[str, Dict[str, Tuple[int, int, int, int]]]]:
+    """Worker de multiprocessing: procesa un rango de bytes del PGN.
+
+    Devuelve (total_games, processed_games, posiciones) donde posiciones
+    usa tuplas planas (wins, draws, losses, count) para abaratar pickling.
+    """
+    filepath, start, end, min_elo, max_depth, use_fast_parser = task
+
+    generator = BookGenerator(min_elo=min_elo, min_games=1, max_depth=max_depth)
+    with open(filepath, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    stream = io.StringIO(data.decode('utf-8', errors='ignore'))
+    if use_fast_parser:
+        generator._process_stream_fast(stream, quiet=True)
+    else:
+        generator._process_stream_python_chess(stream, quiet=True)
+
+    counts = generator._counts
+    positions = {
+        generator._key_prefix[pos_key]: {
+            generator.move_ucis[mid]: tuple(int(c) for c in counts[row])
+            for mid, row in entry
+        }
+        for pos_key, entry in generator.positions.items()
+    }
+    return generator.total_games, generator.processed_games, positions
 
 
 class BookGenerator:
@@ -65,127 +298,363 @@ class BookGenerator:
         self.min_elo = min_elo
         self.min_games = min_games
         self.max_depth = max_depth
-        
-        # Estructura: position_key -> {move_uci -> MoveStats}
-        self.positions: Dict[str, Dict[str, MoveStats]] = defaultdict(lambda: defaultdict(MoveStats))
-        
+
+        # Contadores en un único array global (capacidad, 4) uint32 con
+        # columnas (wins, draws, losses, count): una fila por par
+        # (posición, movimiento). El layout plano permite compilar el
+        # bucle de agregación con Numba y vectorizar los filtros.
+        self._counts = np.zeros((1024, 4), dtype=np.uint32)
+        self._n_rows = 0
+
+        # (clave Zobrist, move_id) -> fila global en _counts
+        self._row_index: Dict[Tuple[int, int], int] = {}
+
+        # clave Zobrist -> lista de pares (move_id, fila)
+        self.positions: Dict[int, list] = {}
+
+        # Prefijo UCI de cada clave Zobrist, materializado una sola vez
+        # por posición única (el libro C++ sigue indexando por prefijo).
+        self._key_prefix: Dict[int, str] = {}
+
+        # Buffers por partida para el flush compilado (_update_stats)
+        self._game_rows = np.empty(max_depth * 2, dtype=np.int64)
+        self._game_cols = np.empty(max_depth * 2, dtype=np.int64)
+
+        # Board compartido para la conversión SAN→UCI: board.reset() entre
+        # partidas es mucho más barato que construir un Board nuevo
+        self._board = chess.Board()
+
+        # Intern de movimientos UCI a enteros pequeños (y tabla inversa)
+        self.move_ids: Dict[str, int] = {}
+        self.move_ucis: List[str] = []
+
         self.total_games = 0
         self.processed_games = 0
+
+    def _move_id(self, move_uci: str) -> int:
+        """Interna un UCI devolviendo su id entero estable."""
+        mid = self.move_ids.get(move_uci)
+        if mid is None:
+            mid = len(self.move_ucis)
+            self.move_ids[move_uci] = mid
+            self.move_ucis.append(move_uci)
+        return mid
+
+    def _move_row(self, pos_key: int, move_uci: str,
+                  move_sequence: List[str] = None) -> int:
+        """Devuelve la fila global de _counts para (posición, movimiento).
+
+        Crea la fila si no existe; el array global crece con np.resize
+        cuando se agota la capacidad. Si se pasa `move_sequence`, el
+        prefijo UCI se materializa la primera vez que aparece la posición.
+        """
+        mid = self._move_id(move_uci)
+        row = self._row_index.get((pos_key, mid))
+        if row is None:
+            if self._n_rows == self._counts.shape[0]:
+                # Crecimiento geométrico: O(n) amortizado en reallocs en
+                # vez de O(n²) con incrementos fijos
+                counts = np.resize(self._counts, (self._n_rows * 2, 4))
+                counts[self._n_rows:] = 0
+                self._counts = counts
+
+            row = self._n_rows
+            self._n_rows = row + 1
+            self._row_index[(pos_key, mid)] = row
+
+            entry = self.positions.get(pos_key)
+            if entry is None:
+                entry = []
+                self.positions[pos_key] = entry
+                if move_sequence is not None:
+                    self._key_prefix[pos_key] = ' '.join(move_sequence)
+            entry.append((mid, row))
+        return row
     
-    def process_pgn_file(self, filepath: str):
-        """Procesa un archivo PGN y extrae estadísticas."""
+    def _passes_filters(self, headers) -> str:
+        """Aplica los filtros de ELO y resultado sobre los headers.
+
+        Devuelve el resultado ("1-0", "0-1", "1/2-1/2") si la partida
+        debe procesarse, o cadena vacía si hay que descartarla.
+        """
+        try:
+            white_elo = int(headers.get("WhiteElo", "0"))
+            black_elo = int(headers.get("BlackElo", "0"))
+        except ValueError:
+            return ''
+
+        if white_elo < self.min_elo or black_elo < self.min_elo:
+            return ''
+
+        result = headers.get("Result", "*")
+        if result not in ("1-0", "0-1", "1/2-1/2"):
+            return ''
+        return result
+
+    def process_pgn_file(self, filepath: str, use_fast_parser: bool = False):
+        """Procesa un archivo PGN y extrae estadísticas.
+
+        Con use_fast_parser=True usa el tokenizador propio (_fast_pgn_iter),
+        que evita construir el árbol Game/Node de python-chess por partida.
+        """
         print(f"Procesando {filepath}...")
-        
+
+        if use_fast_parser:
+            self._process_pgn_file_fast(filepath)
+        else:
+            self._process_pgn_file_python_chess(filepath)
+
+        print(f"\n✓ Procesadas {self.total_games} partidas, usadas {self.processed_games}")
+
+    def _process_pgn_file_python_chess(self, filepath: str):
+        """Recorrido clásico con chess.pgn.read_game (referencia/fallback)."""
         with open(filepath, 'r', encoding='utf-8', errors='ignore') as pgn_file:
-            while True:
-                game = chess.pgn.read_game(pgn_file)
-                if game is None:
-                    break
-                
-                self.total_games += 1
-                
-                if self.total_games % 1000 == 0:
-                    print(f"Procesadas {self.total_games} partidas, "
-                          f"usadas {self.processed_games}...", end='\r')
-                
-                # Filtrar por ELO
-                white_elo = game.headers.get("WhiteElo", "0")
-                black_elo = game.headers.get("BlackElo", "0")
-                
-                try:
-                    white_elo = int(white_elo)
-                    black_elo = int(black_elo)
-                except ValueError:
-                    continue
-                
-                if white_elo < self.min_elo or black_elo < self.min_elo:
-                    continue
-                
-                # Determinar resultado
-                result = game.headers.get("Result", "*")
-                if result not in ["1-0", "0-1", "1/2-1/2"]:
-                    continue
-                
-                self.process_game(game, result)
-                self.processed_games += 1
-        
+            self._process_stream_python_chess(pgn_file)
+
+    def _process_stream_python_chess(self, pgn_file, quiet: bool = False):
+        """Consume un stream PGN ya abierto con chess.pgn.read_game.
+
+        Primero lee solo los headers (chess.pgn.read_headers, que saltea
+        el movetext); el árbol de jugadas completo recién se construye
+        para las partidas que pasan el filtro de ELO/resultado.
+        """
+        while True:
+            offset = pgn_file.tell()
+            headers = chess.pgn.read_headers(pgn_file)
+            if headers is None:
+                break
+
+            self.total_games += 1
+
+            if not quiet and self.total_games % 1000 == 0:
+                print(f"Procesadas {self.total_games} partidas, "
+                      f"usadas {self.processed_games}...", end='\r')
+
+            result = self._passes_filters(headers)
+            if not result:
+                continue
+
+            pgn_file.seek(offset)
+            game = chess.pgn.read_game(pgn_file)
+            if game is None:
+                break
+
+            self.process_game(game, result)
+            self.processed_games += 1
+
+    def _process_pgn_file_fast(self, filepath: str):
+        """Recorrido con el tokenizador streaming (sin árbol de nodos)."""
+        with open(filepath, 'r', encoding='utf-8', errors='ignore') as pgn_file:
+            self._process_stream_fast(pgn_file)
+
+    def process_pgn_file_parallel(self, filepath: str, jobs: int,
+                                  use_fast_parser: bool = False):
+        """Procesa el PGN en paralelo repartiendo rangos de partidas.
+
+        Divide el archivo en `jobs` rangos contiguos alineados a partidas
+        (_scan_game_offsets) y los reparte en un multiprocessing.Pool;
+        el padre reduce los diccionarios parciales sumando W/D/L.
+        """
+        print(f"Procesando {filepath} con {jobs} procesos...")
+
+        offsets = _scan_game_offsets(filepath)
+        if not offsets:
+            print("ERROR: no se encontraron partidas ([Event ...]) en el archivo")
+            return
+
+        # Agrupar partidas en `jobs` rangos contiguos de tamaño similar
+        per_chunk = max(1, (len(offsets) + jobs - 1) // jobs)
+        tasks = []
+        for i in range(0, len(offsets), per_chunk):
+            chunk = offsets[i:i + per_chunk]
+            tasks.append((filepath, chunk[0][0], chunk[-1][1],
+                          self.min_elo, self.max_depth, use_fast_parser))
+
+        # imap (ordenado) y no imap_unordered: el orden de merge define el
+        # orden de inserción en _counts/positions, que a su vez desempata
+        # la selección top-5; con orden de llegada el libro cambiaría de
+        # contenido entre corridas idénticas.
+        with multiprocessing.Pool(processes=min(jobs, len(tasks))) as pool:
+            for total, processed, positions in pool.imap(
+                    _ingest_range, tasks, chunksize=1):
+                self.total_games += total
+                self.processed_games += processed
+                self._merge_positions(positions)
+                print(f"Procesadas {self.total_games} partidas, "
+                      f"usadas {self.processed_games}...", end='\r')
+
         print(f"\n✓ Procesadas {self.total_games} partidas, usadas {self.processed_games}")
+
+    def _merge_positions(self, positions: Dict[str, Dict[str, Tuple[int, int, int, int]]]):
+        """Suma al acumulador las posiciones parciales de un worker.
+
+        Los workers envían prefijos UCI (picklables y estables); aquí se
+        reconvierten a claves Zobrist antes de sumar.
+        """
+        for prefix, moves in positions.items():
+            pos_key = _zobrist_of_prefix(prefix)
+            if pos_key not in self._key_prefix:
+                self._key_prefix[pos_key] = prefix
+            for uci, wdlc in moves.items():
+                row = self._move_row(pos_key, uci)
+                self._counts[row] += np.asarray(wdlc, dtype=np.uint32)
+
+    def _process_stream_fast(self, pgn_file, quiet: bool = False):
+        """Consume un stream PGN ya abierto con _fast_pgn_iter."""
+        for headers, san_tokens in _fast_pgn_iter(pgn_file):
+            self.total_games += 1
+
+            if not quiet and self.total_games % 1000 == 0:
+                print(f"Procesadas {self.total_games} partidas, "
+                      f"usadas {self.processed_games}...", end='\r')
+
+            result = self._passes_filters(headers)
+            if not result:
+                continue
+
+            self.process_game_san(san_tokens, result)
+            self.processed_games += 1
     
     def process_game(self, game: chess.pgn.Game, result: str):
-        """Procesa una partida individual."""
-        board = game.board()
+        """Procesa una partida individual.
+
+        Con las claves Zobrist no hace falta ningún chess.Board: el turno
+        se lleva con un booleano y el resultado se codifica una sola vez.
+        El bucle Python solo resuelve filas; los incrementos se bufferean
+        y se aplican de una vez con _update_stats (compilable con Numba).
+        """
         move_sequence = []
-        
+        pos_key = 0  # clave rodante incremental (startpos = 0)
+        rc = 0 if result == "1-0" else 1 if result == "0-1" else 2
+        white_to_move = True
+        game_rows, game_cols = self._game_rows, self._game_cols
+        n = 0
+
         for i, move in enumerate(game.mainline_moves()):
             if i >= self.max_depth * 2:  # 2 movimientos por jugada (blanco+negro)
                 break
-            
-            # Clave de posición (secuencia de movimientos UCI)
-            pos_key = ' '.join(move_sequence)
+
             move_uci = move.uci()
-            
-            # Actualizar estadísticas
-            stats = self.positions[pos_key][move_uci]
-            if stats.uci == '':
-                stats.uci = move_uci
-            
-            stats.count += 1
-            
-            # Actualizar W/D/L según el resultado y el turno
-            if result == "1/2-1/2":
-                stats.draws += 1
-            elif board.turn == chess.WHITE:  # Movimiento de blancas
-                if result == "1-0":
-                    stats.wins += 1
-                else:
-                    stats.losses += 1
-            else:  # Movimiento de negras
-                if result == "0-1":
-                    stats.wins += 1
-                else:
-                    stats.losses += 1
-            
-            board.push(move)
+
+            game_rows[n] = self._move_row(pos_key, move_uci, move_sequence)
+            game_cols[n] = _WDL_COL[0 if white_to_move else 1][rc]
+            n += 1
+
+            pos_key = ((pos_key * _HASH_MULT) & _HASH_MASK) \
+                ^ _ZOBRIST[move.from_square][move.to_square][move.promotion or 0]
+            white_to_move = not white_to_move
+            move_sequence.append(move_uci)
+
+        _update_stats(game_rows, game_cols, n, self._counts)
+
+    def process_game_san(self, san_tokens: List[str], result: str):
+        """Procesa una partida entregada como tokens SAN (parser rápido).
+
+        Solo usa chess.Board para la conversión SAN→UCI; no construye el
+        árbol de nodos de python-chess.
+        """
+        board = self._board
+        board.reset()
+        move_sequence = []
+        pos_key = 0  # clave rodante incremental (startpos = 0)
+        rc = 0 if result == "1-0" else 1 if result == "0-1" else 2
+        white_to_move = True
+        game_rows, game_cols = self._game_rows, self._game_cols
+        n = 0
+
+        for i, san in enumerate(san_tokens):
+            if i >= self.max_depth * 2:  # 2 movimientos por jugada (blanco+negro)
+                break
+
+            try:
+                move = board.push_san(san)
+            except ValueError:
+                # Token ilegible/ilegal: descartar el resto de la partida
+                break
+
+            move_uci = move.uci()
+
+            game_rows[n] = self._move_row(pos_key, move_uci, move_sequence)
+            game_cols[n] = _WDL_COL[0 if white_to_move else 1][rc]
+            n += 1
+
+            pos_key = ((pos_key * _HASH_MULT) & _HASH_MASK) \
+                ^ _ZOBRIST[move.from_square][move.to_square][move.promotion or 0]
+            white_to_move = not white_to_move
             move_sequence.append(move_uci)
+
+        _update_stats(game_rows, game_cols, n, self._counts)
     
-    def filter_positions(self) -> Dict[str, List[MoveStats]]:
-        """Filtra posiciones manteniendo solo movimientos con suficientes partidas."""
+    def filter_positions(self) -> Dict[str, List[BookMove]]:
+        """Filtra posiciones manteniendo solo movimientos con suficientes partidas.
+
+        Score y peso se calculan vectorizados sobre los contadores uint32
+        en lugar de por-objeto como hacía el viejo MoveStats.
+        """
         filtered = {}
-        
-        for pos_key, moves in self.positions.items():
+
+        for pos_key, entry in self.positions.items():
+            rows = np.array([row for _, row in entry], dtype=np.int64)
+            counts = self._counts[rows]
+            total = counts[:, _N]
+
             # Filtrar movimientos con pocas partidas
+            mask = total >= self.min_games
+            if not mask.any():
+                continue
+
+            scores = (counts[:, _W] + 0.5 * counts[:, _D]) / total
+            popularity = np.minimum(100, (20 * np.log(total + 1)).astype(np.int64))
+            weights = np.clip((popularity + (scores * 100).astype(np.int64)) // 2,
+                              0, 100)
+
+            # Selección parcial del top 5 por (score, count) con claves
+            # exactas: argpartition por score poda los candidatos sin
+            # ordenarlos todos, conservando los empates en el corte, y
+            # el lexsort final desempata por count y por índice de
+            # inserción (igual que el viejo sort estable). Nada de claves
+            # flotantes compuestas: perdían precisión con counts grandes.
+            idx = np.flatnonzero(mask)
+            if idx.size > 5:
+                kth = scores[idx[np.argpartition(-scores[idx], 4)[4]]]
+                idx = idx[scores[idx] >= kth]
+
+            order = np.lexsort((idx, -total[idx].astype(np.int64), -scores[idx]))
+            idx = idx[order[:5]]
+
             good_moves = [
-                stats for stats in moves.values() 
-                if stats.count >= self.min_games
+                BookMove(uci=self.move_ucis[entry[i][0]],
+                         count=int(total[i]),
+                         score=float(scores[i]),
+                         weight=int(weights[i]))
+                for i in idx
             ]
-            
-            if not good_moves:
-                continue
-            
-            # Ordenar por score y popularidad
-            good_moves.sort(key=lambda s: (s.score, s.count), reverse=True)
-            
-            # Limitar a top 5 movimientos
-            filtered[pos_key] = good_moves[:5]
-        
+
+            # El libro C++ indexa por prefijo UCI
+            filtered[self._key_prefix[pos_key]] = good_moves
+
         return filtered
     
     def generate_cpp_code(self, output_path: str):
         """Genera el código C++ del opening book."""
+        from datetime import datetime
+
         filtered = self.filter_positions()
-        
+
         print(f"\nGenerando código C++...")
         print(f"  Posiciones incluidas: {len(filtered)}")
         print(f"  Movimientos totales: {sum(len(v) for v in filtered.values())}")
-        
-        with open(output_path, 'w', encoding='utf-8') as f:
-            f.write(self._generate_header())
-            f.write(self._generate_table(filtered))
+
+        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+        with open(output_path, 'w', buffering=1 << 20, encoding='utf-8') as f:
+            f.write(self._generate_header(len(filtered), timestamp))
+            self._write_table(f, filtered)
             f.write(self._generate_footer())
-        
+
         print(f"✓ Archivo generado: {output_path}")
     
-    def _generate_header(self) -> str:
+    def _generate_header(self, total_positions: int, timestamp: str) -> str:
         return '''#include "opening_book.h"
 
 #include <algorithm>
@@ -194,65 +663,67 @@ class BookGenerator:
 #include <unordered_map>
 #include <vector>
 
-namespace {
+namespace {{
 
 using BookTable = std::unordered_map<std::string, std::vector<BookCandidate>>;
 
-static std::string make_key(const std::vector<std::string>& moves) {
+static std::string make_key(const std::vector<std::string>& moves) {{
   std::string key;
-  for (size_t i = 0; i < moves.size(); ++i) {
+  for (size_t i = 0; i < moves.size(); ++i) {{
     if (i) key += ' ';
     key += moves[i];
-  }
+  }}
   return key;
-}
+}}
 
 // Opening book generado automáticamente desde base de datos PGN
 // Criterios:
 //   - ELO mínimo: {min_elo}
 //   - Partidas mínimas por movimiento: {min_games}
 //   - Profundidad máxima: {max_depth} jugadas
-//   - Total de posiciones: {{total_positions}}
-//   - Fecha de generación: {{timestamp}}
+//   - Total de posiciones: {total_positions}
+//   - Fecha de generación: {timestamp}
 
 static const BookTable& opening_book_table() {{
   static const BookTable table = {{
-'''.format(min_elo=self.min_elo, min_games=self.min_games, max_depth=self.max_depth)
+'''.format(min_elo=self.min_elo, min_games=self.min_games,
+           max_depth=self.max_depth, total_positions=total_positions,
+           timestamp=timestamp)
     
-    def _generate_table(self, filtered: Dict[str, List[MoveStats]]) -> str:
-        from datetime import datetime
-        
-        lines = []
-        
-        # Ordenar posiciones por longitud (startpos primero)
-        sorted_positions = sorted(filtered.items(), key=lambda x: len(x[0]))
-        
+    def _write_table(self, f, filtered: Dict[str, List[BookMove]]):
+        """Escribe la tabla del libro directamente al archivo de salida.
+
+        Emitir posición por posición mantiene la memoria pico en O(1)
+        respecto del tamaño del libro (antes se acumulaba todo el .cpp
+        en un buffer y se copiaba una vez más al escribirlo).
+        """
+        write = f.write
+
+        # Ordenar posiciones por longitud (startpos primero); el prefijo
+        # desempata para que la salida sea byte-estable también con --jobs,
+        # donde el orden de inserción depende de la llegada de los workers
+        sorted_positions = sorted(filtered.items(), key=lambda x: (len(x[0]), x[0]))
+
         for pos_key, moves in sorted_positions:
             # Comentario con estadísticas
             total_games = sum(m.count for m in moves)
             avg_score = sum(m.score * m.count for m in moves) / total_games if total_games > 0 else 0.5
-            
-            comment = f"      // Games: {total_games}, Avg score: {avg_score:.3f}"
-            
+
+            write(f"      // Games: {total_games}, Avg score: {avg_score:.3f}\n")
+
             # Generar línea del libro
-            candidates = ', '.join(
-                f'{{\"{m.uci}\", {m.weight}}}'
-                for m in moves
-            )
-            
-            line = f'      {{\"{pos_key}\", {{{candidates}}}}},'
-            
-            lines.append(comment)
-            lines.append(line)
-            lines.append('')
-        
-        # Reemplazar timestamp y total_positions en el header
-        result = '\n'.join(lines)
-        header = self._generate_header()
-        header = header.replace('{{total_positions}}', str(len(filtered)))
-        header = header.replace('{{timestamp}}', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-        
-        return result
+            write('      {"')
+            write(pos_key)
+            write('", {')
+            for i, m in enumerate(moves):
+                if i:
+                    write(', ')
+                write('{"')
+                write(m.uci)
+                write('", ')
+                write(str(m.weight))
+                write('}')
+            write('}},\n\n')
     
     def _generate_footer(self) -> str:
         return '''  };
@@ -322,16 +793,18 @@ std::optional<std::string> opening_book_pick(
             print(f"  Jugada {depth:2d}: {depth_dist[depth]:4d} posiciones")
         print()
         
-        # Top movimientos
-        all_moves = []
-        for moves in filtered.values():
-            all_moves.extend(moves)
-        
-        move_counter = Counter(m.uci for m in all_moves)
-        
+        # Top movimientos: conteo nativo sobre los ids internados en vez
+        # de un Counter de strings por elemento
+        surviving_mids = np.fromiter(
+            (self.move_ids[m.uci] for moves in filtered.values() for m in moves),
+            dtype=np.int64,
+        )
+
         print(f"🔝 MOVIMIENTOS MÁS COMUNES:")
-        for uci, count in move_counter.most_common(15):
-            print(f"  {uci}: {count} apariciones")
+        if surviving_mids.size:
+            uniq, cnt = np.unique(surviving_mids, return_counts=True)
+            for i in np.argsort(-cnt, kind='stable')[:15]:
+                print(f"  {self.move_ucis[uniq[i]]}: {cnt[i]} apariciones")
         print()
 
 
@@ -339,7 +812,7 @@ def main():
     parser = argparse.ArgumentParser(
         description='Genera opening book desde archivos PGN'
     )
-    parser.add_argument('--input', '-i', required=True,
+    parser.add_argument('--input', '-i',
                        help='Archivo PGN de entrada')
     parser.add_argument('--output', '-o', default='opening_book_generated.cpp',
                        help='Archivo de salida (default: opening_book_generated.cpp)')
@@ -349,8 +822,24 @@ def main():
                        help='Mínimo de partidas por movimiento (default: 5)')
     parser.add_argument('--max-depth', type=int, default=15,
                        help='Profundidad máxima en jugadas (default: 15)')
-    
+    parser.add_argument('--fast-parser', action='store_true',
+                       help='Usar el tokenizador PGN streaming (más rápido '
+                            'que chess.pgn en archivos grandes)')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                       help='Procesos en paralelo para la ingesta '
+                            '(default: 1, secuencial)')
+    parser.add_argument('--precompile', action='store_true',
+                       help='Solo precompilar los kernels Numba y salir '
+                            '(útil como paso de preparación)')
+
     args = parser.parse_args()
+
+    if args.precompile:
+        precompile_kernels()
+        return
+
+    if not args.input:
+        parser.error('--input es requerido (salvo con --precompile)')
     
     generator = BookGenerator(
         min_elo=args.min_elo,
@@ -358,7 +847,11 @@ def main():
         max_depth=args.max_depth
     )
     
-    generator.process_pgn_file(args.input)
+    if args.jobs > 1:
+        generator.process_pgn_file_parallel(args.input, jobs=args.jobs,
+                                            use_fast_parser=args.fast_parser)
+    else:
+        generator.process_pgn_file(args.input, use_fast_parser=args.fast_parser)
     generator.generate_cpp_code(args.output)
     generator.print_statistics()
     
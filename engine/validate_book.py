@@ -1,60 +1,173 @@
 #!/usr/bin/env python3
 """Valida legalidad de líneas BookLine en opening_book_improved.cpp.
 
+Opcionalmente evalúa cada movimiento del libro con Stockfish
+(--engine-path), repartiendo las posiciones entre varios procesos de
+motor en paralelo.
+
 Uso:
   python engine/validate_book.py
   python engine/validate_book.py --book-file engine/opening_book_improved.cpp
+  python engine/validate_book.py --engine-path /usr/bin/stockfish --workers 4
 """
 
 from __future__ import annotations
 
 import argparse
-import re
+import mmap
+import pickle
+import queue
 import sys
+import threading
 from collections import defaultdict
 from pathlib import Path
 
 try:
     import chess
+    import chess.engine
 except ImportError:
     print("ERROR: falta python-chess. Instala con: pip install python-chess")
     sys.exit(1)
 
-LINE_RE = re.compile(
-    r"\{\s*(?:MAIN_LINE|GOOD_ALT|\d+)\s*,\s*\{([^}]*)\}\s*\}",
-    re.MULTILINE,
-)
-MOVE_RE = re.compile(r'"([a-h][1-8][a-h][1-8][qrbn]?)"')
-
-
-def parse_book_lines(cpp_path: Path) -> list[list[str]]:
-    text = cpp_path.read_text(encoding="utf-8")
-    blocks = LINE_RE.findall(text)
-    lines: list[list[str]] = []
-    for block in blocks:
-        moves = MOVE_RE.findall(block)
-        if moves:
-            lines.append(moves)
+_LINE_TAGS = (b"MAIN_LINE", b"GOOD_ALT")
+
+# Cache persistente de evaluaciones, indexado por (motor, profundidad)
+_EVAL_CACHE_FILE = Path(".book_eval_cache.pkl")
+
+
+def _load_eval_cache() -> dict:
+    try:
+        with open(_EVAL_CACHE_FILE, "rb") as f:
+            return pickle.load(f)
+    except (OSError, pickle.PickleError, EOFError):
+        return {}
+
+
+def _save_eval_cache(caches: dict):
+    try:
+        with open(_EVAL_CACHE_FILE, "wb") as f:
+            pickle.dump(caches, f)
+    except OSError:
+        pass  # el cache es solo una optimización
+
+
+def _fen_key(board: chess.Board) -> str:
+    """Clave de posición sin contadores de jugadas (4 primeros campos FEN)."""
+    return " ".join(board.fen().split()[:4])
+
+
+# Cache UCI -> chess.Move: el mismo movimiento aparece en muchas líneas y
+# Move.from_uci re-parsea el string cada vez. Acotado (~4200 UCIs legales).
+_MOVE_CACHE: dict[str, chess.Move] = {}
+
+
+def _mv(uci: str) -> chess.Move:
+    move = _MOVE_CACHE.get(uci)
+    if move is None:
+        move = chess.Move.from_uci(uci)
+        _MOVE_CACHE[uci] = move
+    return move
+
+
+def _is_uci(token: bytes) -> bool:
+    """True si el token parece un movimiento UCI (e2e4, e7e8q, ...)."""
+    if not 4 <= len(token) <= 5:
+        return False
+    if not (b"a"[0] <= token[0] <= b"h"[0] and b"1"[0] <= token[1] <= b"8"[0]
+            and b"a"[0] <= token[2] <= b"h"[0] and b"1"[0] <= token[3] <= b"8"[0]):
+        return False
+    return len(token) == 4 or token[4:5] in (b"q", b"r", b"b", b"n")
+
+
+def parse_book_lines(cpp_path: Path) -> list[tuple[int, list[str]]]:
+    """Extrae las PVs de los bloques BookLine del .cpp, con su peso.
+
+    Escaneo lineal sobre el archivo mmapeado en lugar del viejo
+    re.findall: se buscan bloques `{MAIN_LINE|GOOD_ALT|<peso>, {...}}`
+    y se recolectan los strings UCI de su interior siguiendo la
+    profundidad de llaves, sin backtracking ni copia completa del texto.
+
+    Returns:
+        Lista de tuplas (peso, movimientos UCI).
+    """
+    lines: list[tuple[int, list[str]]] = []
+    with open(cpp_path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        size = len(mm)
+        i = 0
+        while True:
+            i = mm.find(b"{", i)
+            if i == -1:
+                break
+
+            # Token hasta la coma: ¿es un peso de BookLine?
+            j = i + 1
+            while j < size and mm[j:j + 1] in b" \t\r\n":
+                j += 1
+            k = j
+            while k < size and mm[k:k + 1] not in b',{}"':
+                k += 1
+            token = mm[j:k].strip()
+
+            if mm[k:k + 1] != b"," or not (token in _LINE_TAGS or token.isdigit()):
+                i += 1
+                continue
+
+            if token == b"MAIN_LINE":
+                weight = 100
+            elif token == b"GOOD_ALT":
+                weight = 70
+            else:
+                weight = int(token)
+
+            # Recolectar strings UCI hasta cerrar el bloque
+            moves: list[str] = []
+            depth = 1
+            p = k + 1
+            while p < size and depth > 0:
+                ch = mm[p:p + 1]
+                if ch == b"{":
+                    depth += 1
+                elif ch == b"}":
+                    depth -= 1
+                elif ch == b'"':
+                    q = mm.find(b'"', p + 1)
+                    if q == -1:
+                        p = size
+                        break
+                    literal = mm[p + 1:q]
+                    if _is_uci(literal):
+                        moves.append(literal.decode("ascii"))
+                    p = q
+                p += 1
+
+            if moves:
+                lines.append((weight, moves))
+            i = p
+    finally:
+        mm.close()
     return lines
 
 
 def validate_lines(lines: list[list[str]]) -> int:
     errors = 0
-    key_collisions: dict[str, set[str]] = defaultdict(set)
+    # Claves tupla: evita rearmar " ".join(hist) en cada ply (O(depth²))
+    key_collisions: dict[tuple[str, ...], set[str]] = defaultdict(set)
+    board = chess.Board()  # un solo Board, reseteado por línea
 
     for idx, pv in enumerate(lines, start=1):
-        board = chess.Board()
+        board.reset()
         hist: list[str] = []
 
         for ply, uci in enumerate(pv, start=1):
-            move = chess.Move.from_uci(uci)
-            if move not in board.legal_moves:
+            move = _mv(uci)
+            if not board.is_legal(move):
                 print(f"❌ Línea {idx}, ply {ply}: movimiento ilegal {uci} después de {' '.join(hist) or '<startpos>'}")
                 errors += 1
                 break
 
-            prefix = " ".join(hist)
-            key_collisions[prefix].add(uci)
+            key_collisions[tuple(hist)].add(uci)
             board.push(move)
             hist.append(uci)
 
@@ -65,7 +178,7 @@ def validate_lines(lines: list[list[str]]) -> int:
     if multi:
         print("Ejemplos de colisiones:")
         for i, (k, v) in enumerate(sorted(multi.items())[:8], start=1):
-            pfx = k if k else "<startpos>"
+            pfx = " ".join(k) if k else "<startpos>"
             print(f"  {i}. {pfx} -> {sorted(v)}")
 
     if errors == 0:
@@ -73,9 +186,151 @@ def validate_lines(lines: list[list[str]]) -> int:
     return errors
 
 
+def _collect_jobs(entries: list[tuple[int, list[str]]]) -> list[tuple[int, int, str, str]]:
+    """Genera los trabajos (línea, ply, fen_antes, uci) de todas las PVs.
+
+    Las líneas con peso <= 0 se saltean: el selector C++ nunca las juega
+    (`if (candidate.weight <= 0) continue;`), así que analizarlas sería
+    cómputo desperdiciado.
+    """
+    jobs: list[tuple[int, int, str, str]] = []
+    seen: set[tuple[str, str]] = set()
+    board = chess.Board()  # un solo Board, reseteado por línea
+
+    for idx, (weight, pv) in enumerate(entries, start=1):
+        if weight <= 0:
+            continue
+        board.reset()
+        for ply, uci in enumerate(pv, start=1):
+            move = _mv(uci)
+            if not board.is_legal(move):
+                break  # validate_lines ya reporta la ilegalidad
+
+            fen = board.fen()
+            if (fen, uci) not in seen:
+                seen.add((fen, uci))
+                jobs.append((idx, ply, fen, uci))
+            board.push(move)
+
+    return jobs
+
+
+def analyze_lines(entries: list[tuple[int, list[str]]], engine_path: str,
+                  workers: int = 1, threads_per_engine: int = 1,
+                  depth: int = 12, threshold_cp: int = -50) -> int:
+    """Evalúa cada movimiento del libro con Stockfish en paralelo.
+
+    Lanza `workers` procesos de motor independientes (el GIL no importa:
+    el trabajo pesado ocurre fuera de Python) y reparte las posiciones
+    vía una cola. Las evaluaciones se memoizan por FEN post-movimiento
+    (las transposiciones colapsan en una sola llamada al motor) y el
+    cache se persiste en .book_eval_cache.pkl entre corridas. Reporta
+    movimientos cuya evaluación, desde el punto de vista de quien mueve,
+    queda por debajo de `threshold_cp`.
+
+    Returns:
+        Cantidad de movimientos sospechosos encontrados.
+    """
+    jobs: queue.Queue = queue.Queue()
+    all_jobs = _collect_jobs(entries)
+    for job in all_jobs:
+        jobs.put(job)
+
+    print(f"\nAnalizando {len(all_jobs)} posiciones con {workers} motores "
+          f"(profundidad {depth})...")
+
+    results: list[tuple[int, int, str, int]] = []
+    lock = threading.Lock()
+    hits = 0
+
+    def worker(engine: chess.engine.SimpleEngine, cache: dict[str, int]):
+        nonlocal hits
+        board = chess.Board()
+        while True:
+            try:
+                idx, ply, fen, uci = jobs.get_nowait()
+            except queue.Empty:
+                return
+
+            board.set_fen(fen)
+            board.push(_mv(uci))
+            key = _fen_key(board)
+
+            with lock:
+                score = cache.get(key)
+
+            if score is None:
+                # Pasada superficial primero: si ya aparece un mate o una
+                # eval decidida, la búsqueda profunda no aporta nada
+                info = engine.analyse(board, chess.engine.Limit(depth=min(6, depth)))
+                # Score desde la perspectiva de quien hizo el movimiento
+                pov = info["score"].pov(not board.turn)
+                score = pov.score(mate_score=10000)
+                if depth > 6 and not pov.is_mate() and abs(score) < 1000:
+                    info = engine.analyse(board, chess.engine.Limit(depth=depth))
+                    score = info["score"].pov(not board.turn).score(mate_score=10000)
+                with lock:
+                    cache[key] = score
+            else:
+                with lock:
+                    hits += 1
+
+            with lock:
+                results.append((idx, ply, uci, score))
+
+    engines = []
+    try:
+        for _ in range(workers):
+            engine = chess.engine.SimpleEngine.popen_uci(engine_path)
+            # Registrar el motor antes de configure(): si configure falla,
+            # el finally igual lo cierra (si no, su thread de fondo no-daemon
+            # dejaría el intérprete colgado al salir)
+            engines.append(engine)
+            engine.configure({"Threads": threads_per_engine, "Hash": 64})
+
+        # Cache compartido entre threads, particionado por motor/profundidad
+        # para no mezclar evaluaciones de binarios o límites distintos
+        caches = _load_eval_cache()
+        cache = caches.setdefault((engines[0].id.get("name", engine_path), depth), {})
+
+        threads = [threading.Thread(target=worker, args=(engine, cache))
+                   for engine in engines]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        _save_eval_cache(caches)
+        if hits:
+            print(f"  (cache: {hits} transposiciones reutilizadas)")
+    finally:
+        for engine in engines:
+            engine.quit()
+
+    suspicious = sorted((r for r in results if r[3] < threshold_cp),
+                        key=lambda r: r[3])
+
+    print(f"Movimientos analizados: {len(results)}")
+    if suspicious:
+        print(f"⚠️  Movimientos con eval < {threshold_cp}cp para quien mueve:")
+        for idx, ply, uci, score in suspicious:
+            print(f"  Línea {idx}, ply {ply}: {uci} -> {score}cp")
+    else:
+        print(f"✅ Ningún movimiento por debajo de {threshold_cp}cp")
+    return len(suspicious)
+
+
 def main() -> int:
     parser = argparse.ArgumentParser(description="Validar BookLine PVs")
     parser.add_argument("--book-file", default="engine/opening_book_improved.cpp")
+    parser.add_argument("--engine-path", default=None,
+                        help="Binario UCI (p.ej. stockfish) para evaluar el libro")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Motores en paralelo (default: 1)")
+    parser.add_argument("--threads-per-engine", type=int, default=1,
+                        help="Threads UCI por motor (default: 1)")
+    parser.add_argument("--depth", type=int, default=12,
+                        help="Profundidad de análisis (default: 12)")
     args = parser.parse_args()
 
     cpp_path = Path(args.book_file)
@@ -83,12 +338,20 @@ def main() -> int:
         print(f"ERROR: no existe {cpp_path}")
         return 2
 
-    lines = parse_book_lines(cpp_path)
-    if not lines:
+    entries = parse_book_lines(cpp_path)
+    if not entries:
         print("ERROR: no se pudieron parsear líneas BookLine")
         return 2
 
-    return 1 if validate_lines(lines) else 0
+    # La legalidad se valida siempre, incluso para líneas con peso 0
+    errors = validate_lines([pv for _, pv in entries])
+
+    if args.engine_path:
+        analyze_lines(entries, args.engine_path, workers=args.workers,
+                      threads_per_engine=args.threads_per_engine,
+                      depth=args.depth)
+
+    return 1 if errors else 0
 
 
 if __name__ == "__main__":